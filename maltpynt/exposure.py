@@ -13,6 +13,221 @@ from .io import get_file_type, save_lcurve, MP_FILE_EXTENSION
 from .base import create_gti_mask, mp_root, _assign_value_if_none
 import logging
 import warnings
+try:
+    from numba import njit, prange, get_num_threads
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(**kwargs):
+        """Dummy decorator in case numba cannot be imported."""
+        return lambda fun: fun
+
+# Set to True to check the internal consistency of the exposure calculation.
+# These checks scan full event arrays and are off by default.
+_SLOW_CHECKS = False
+
+# Number of events processed at a time by the numpy version of the livetime
+# calculation. About eight float64 arrays of this size fit in 2 MB of cache.
+# Also the minimum number of events per thread in the Numba version.
+_CHUNK_SIZE = 2 ** 15
+
+
+def _is_uniform(tbins):
+    """Check if bin edges (or times) are equally spaced.
+
+    The tolerance is a small fraction of the bin width, so that the bin
+    found arithmetically is off by at most one bin.
+    """
+    nbin = len(tbins) - 1
+    if nbin < 1:
+        return False
+    bin_width = (tbins[-1] - tbins[0]) / nbin
+    expected = tbins[0] + np.arange(nbin + 1) * bin_width
+    return np.allclose(tbins, expected, rtol=0, atol=1e-3 * bin_width)
+
+
+def _find_bins(tbins, values, uniform=False):
+    """Find the bin of `tbins` each value belongs to.
+
+    Equivalent to ``np.searchsorted(tbins[:-1], values, 'right') - 1``. If
+    the bins are uniform, the index is calculated directly from the bin width
+    and corrected for rounding errors near the bin edges, avoiding the binary
+    search.
+    """
+    if not uniform:
+        return np.searchsorted(tbins[:-1], values, 'right') - 1
+
+    nbin = len(tbins) - 1
+    bin_width = (tbins[-1] - tbins[0]) / nbin
+    idx = np.floor((values - tbins[0]) / bin_width).astype(np.intp)
+    np.clip(idx, 0, nbin - 1, out=idx)
+
+    idx[values < tbins[idx]] -= 1
+    idx[(values >= tbins[idx + 1]) & (idx < nbin - 1)] += 1
+    return idx
+
+
+@njit(cache=True)
+def _find_bin_scalar(tbins, value, uniform):
+    """Scalar version of `_find_bins`, for use inside compiled loops."""
+    nbin = len(tbins) - 1
+    if uniform:
+        bin_width = (tbins[-1] - tbins[0]) / nbin
+        idx = int(np.floor((value - tbins[0]) / bin_width))
+        idx = min(max(idx, 0), nbin - 1)
+        if value < tbins[idx]:
+            idx -= 1
+        elif idx < nbin - 1 and value >= tbins[idx + 1]:
+            idx += 1
+        return idx
+
+    lo = 0
+    hi = nbin
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if tbins[mid] <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo - 1
+
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _livetime_core(ev_fl, pr_fl, livetime_starts, tbins, dt, uniform,
+                   livetime_array):
+    """Accumulate the livetime of each event into the light curve bins."""
+    for k in range(len(ev_fl)):
+        lts_bin = _find_bin_scalar(tbins, livetime_starts[k], uniform)
+        ev_bin = _find_bin_scalar(tbins, ev_fl[k], uniform)
+
+        if ev_bin == lts_bin:
+            livetime_array[ev_bin] += pr_fl[k]
+        elif ev_bin > lts_bin:
+            livetime_array[ev_bin] += ev_fl[k] - tbins[ev_bin]
+            livetime_array[lts_bin] += tbins[lts_bin + 1] - livetime_starts[k]
+            for i in range(lts_bin + 1, ev_bin):
+                livetime_array[i] += dt[i]
+
+    return livetime_array
+
+
+@njit(cache=True, parallel=True)
+def _livetime_core_parallel(ev_fl, pr_fl, livetime_starts, tbins, dt,
+                            uniform, livetime_array, n_blocks):
+    """Run `_livetime_core` on contiguous blocks of events in parallel.
+
+    Each block accumulates into its own local histogram, and the histograms
+    are summed at the end, so that no two threads ever write to the same
+    bin. Events are sorted, so each block only covers a narrow range of
+    bins: local histograms cover that range only, and together use about
+    as much memory as `livetime_array`, whatever the number of blocks.
+    """
+    n_ev = len(ev_fl)
+    if n_ev == 0:
+        return livetime_array
+    block_size = (n_ev + n_blocks - 1) // n_blocks
+    n_blocks = (n_ev + block_size - 1) // block_size
+
+    # Range of bins touched by each block
+    los = np.zeros(n_blocks, dtype=np.int64)
+    his = np.zeros(n_blocks, dtype=np.int64)
+    for b in prange(n_blocks):
+        start = b * block_size
+        stop = min(start + block_size, n_ev)
+        tmin = min(livetime_starts[start:stop].min(), ev_fl[start:stop].min())
+        tmax = max(livetime_starts[start:stop].max(), ev_fl[start:stop].max())
+        los[b] = _find_bin_scalar(tbins, tmin, uniform)
+        his[b] = _find_bin_scalar(tbins, tmax, uniform)
+
+    # All local histograms live in a single buffer
+    offsets = np.zeros(n_blocks + 1, dtype=np.int64)
+    for b in range(n_blocks):
+        offsets[b + 1] = offsets[b] + his[b] - los[b] + 1
+    hists = np.zeros(offsets[-1])
+
+    for b in prange(n_blocks):
+        start = b * block_size
+        stop = min(start + block_size, n_ev)
+        lo = los[b]
+        hi = his[b]
+        _livetime_core(ev_fl[start:stop], pr_fl[start:stop],
+                       livetime_starts[start:stop], tbins[lo:hi + 2],
+                       dt[lo:hi + 1], uniform,
+                       hists[offsets[b]:offsets[b + 1]])
+
+    for b in range(n_blocks):
+        livetime_array[los[b]:his[b] + 1] += hists[offsets[b]:offsets[b + 1]]
+
+    return livetime_array
+
+
+def _add_to_bins(livetime_array, idx, weights):
+    """Add weights to livetime_array at the (possibly repeated) indices idx.
+
+    Events are sorted, so a chunk of events only covers a narrow range of
+    bins: the bincount is done on that range only.
+    """
+    if len(idx) == 0:
+        return
+    lo = idx.min()
+    counts = np.bincount(idx - lo, weights=weights)
+    livetime_array[lo:lo + len(counts)] += counts
+
+
+def _livetime_chunk(ev_fl, pr_fl, livetime_starts, tbins, dt, uniform,
+                    livetime_array):
+    """Add the livetime of a chunk of events to livetime_array.
+
+    Vectorized version of `_livetime_core`, used if Numba is not available.
+    """
+    tbin_starts = tbins[:-1]
+    tbin_ends = tbins[1:]
+
+    # Find bins to which "livetime starts" and "events" belong
+    lts_bin = _find_bins(tbins, livetime_starts, uniform)
+    ev_bin = _find_bins(tbins, ev_fl, uniform)
+
+    # First of all, just consider livetimes and events inside the same bin.
+    # The bins are already known, so a weighted bincount is enough.
+    first_pass = ev_bin == lts_bin
+    if __debug__ and _SLOW_CHECKS:
+        assert np.all(pr_fl[first_pass] >= 0), pr_fl[first_pass]
+    _add_to_bins(livetime_array, ev_bin[first_pass], pr_fl[first_pass])
+
+    # Now, let's consider the case where livetime starts some bins before.
+    # All these events are treated at once: each of them contributes a
+    # partial bin at the event, a partial bin at the start of the livetime,
+    # and a number of complete bins in between. The bins are already known,
+    # so the bin boundaries are just looked up.
+    spans = ev_bin > lts_bin
+    ev_bin_good = ev_bin[spans]
+    lts_bin_good = lts_bin[spans]
+    ev_good = ev_fl[spans]
+    lt_good = livetime_starts[spans]
+
+    ev_piece = ev_good - tbin_starts[ev_bin_good]
+    if __debug__ and _SLOW_CHECKS:
+        assert np.all(ev_piece >= 0), \
+            "Invalid boundaries. Contact the developer: {}".format(ev_piece)
+    _add_to_bins(livetime_array, ev_bin_good, ev_piece)
+
+    lt_piece = tbin_ends[lts_bin_good] - lt_good
+    if __debug__ and _SLOW_CHECKS:
+        assert np.all(lt_piece >= 0), \
+            "Invalid boundaries. Contact the developer: {}".format(lt_piece)
+    _add_to_bins(livetime_array, lts_bin_good, lt_piece)
+
+    # Complete bins. Build the ragged list of bin indices
+    # [lts_bin + 1, ..., ev_bin - 1] for all events without a Python loop
+    n_complete = ev_bin_good - lts_bin_good - 1
+    n_total = np.sum(n_complete)
+    if n_total > 0:
+        offsets = np.arange(n_total) - \
+            np.repeat(np.cumsum(n_complete) - n_complete, n_complete)
+        complete_bins = np.repeat(lts_bin_good + 1, n_complete) + offsets
+        _add_to_bins(livetime_array, complete_bins, dt[complete_bins])
 
 
 def get_livetime_per_bin(times, events, priors, dt=None, gti=None):
@@ -46,27 +261,35 @@ def get_livetime_per_bin(times, events, priors, dt=None, gti=None):
     assert len(events) == len(priors), \
         "`events` and `priors` must be of the same length"
 
-    dt = _assign_value_if_none(dt, np.median(np.diff(times)))
+    # Only calculate the default when needed: the median sorts the whole
+    # array of time differences. On a uniform grid it is just the step.
+    if dt is None and _is_uniform(times):
+        dt = (times[-1] - times[0]) / (len(times) - 1)
+    elif dt is None:
+        dt = np.median(np.diff(times))
 
-    try:
-        len(dt)
-    except:
-        dt = dt + np.zeros(len(times))
+    # A single bin width is broadcast to all bins as a read-only view,
+    # without allocating a new array
+    if np.ndim(dt) == 0:
+        dt = np.broadcast_to(np.float64(dt), np.shape(times))
 
-    # Floating point events, starting from events[0]
-    ev_fl = np.array(events - events[0], dtype=np.float64)
-    pr_fl = np.array(priors, dtype=np.float64)
+    # Floating point events, starting from events[0]. The subtraction is done
+    # in the precision of the input and cast directly into the output buffer
+    ev_fl = np.empty(len(events), dtype=np.float64)
+    np.subtract(events, events[0], out=ev_fl)
+    pr_fl = np.asarray(priors, dtype=np.float64)
 
     # Start of livetime
     livetime_starts = ev_fl - pr_fl
 
     # Time bin borders: start from half a bin before tstart, end half a bin
     # after tstop
-    tbins = np.array(
-        np.append(times - dt / 2, [times[-1] + dt[-1] / 2]) - events[0],
-        dtype=np.float64)
+    tbins = np.empty(len(times) + 1, dtype=np.float64)
+    np.subtract(times, events[0], out=tbins[:-1])
+    tbins[:-1] -= dt / 2
+    tbins[-1] = times[-1] + dt[-1] / 2 - events[0]
 
-    tbin_starts = tbins[:-1]
+    uniform = _is_uniform(tbins)
 
     # Filter points outside of range of light curve
     filter = (ev_fl > tbins[0]) & (livetime_starts < tbins[-1])
@@ -74,66 +297,31 @@ def get_livetime_per_bin(times, events, priors, dt=None, gti=None):
     pr_fl = pr_fl[filter]
     livetime_starts = livetime_starts[filter]
 
-    livetime_array = np.zeros_like(times)
+    # Always accumulate in double precision, whatever the type of `times`
+    # (often long double, which Numba does not support)
+    livetime_array = np.zeros(len(times), dtype=np.float64)
 
     # ------ Normalize priors at the start and end of light curve ----------
-    before_start = \
-        (livetime_starts < tbin_starts[0]) & (ev_fl > tbin_starts[0])
-
-    livetime_starts[before_start] = tbins[0] + 1e-9
-    pr_fl[before_start] = ev_fl[before_start] - livetime_starts[before_start]
-
-    after_end = \
-        (livetime_starts < tbins[-1]) & (ev_fl > tbins[-1])
-    ev_fl[after_end] = tbins[-1] - 1e-9
-    pr_fl[after_end] = ev_fl[after_end] - livetime_starts[after_end]
+    # After filtering, all events are after the start of the light curve and
+    # all livetimes start before its end, so clamping is enough
+    np.maximum(livetime_starts, tbins[0] + 1e-9, out=livetime_starts)
+    np.minimum(ev_fl, tbins[-1] - 1e-9, out=ev_fl)
+    np.subtract(ev_fl, livetime_starts, out=pr_fl)
 
     # ----------------------------------------------------------------------
 
-    # Find bins to which "livetime starts" and "events" belong
-    lts_bin = np.searchsorted(tbin_starts, livetime_starts, 'right') - 1
-    ev_bin = np.searchsorted(tbin_starts, ev_fl, 'right') - 1
-
-    # First of all, just consider livetimes and events inside the same bin.
-    first_pass = ev_bin == lts_bin
-    expo, bins = np.histogram(ev_fl[first_pass], bins=tbins,
-                              weights=pr_fl[first_pass])
-
-    assert np.all(expo) >= 0, expo
-    livetime_array += expo
+    if HAS_NUMBA:
+        n_blocks = max(1, min(get_num_threads(), len(ev_fl) // _CHUNK_SIZE))
+        return _livetime_core_parallel(ev_fl, pr_fl, livetime_starts, tbins,
+                                       np.asarray(dt, dtype=np.float64),
+                                       uniform, livetime_array, n_blocks)
 
-    # Now, let's consider the case where livetime starts some bins before.
-    # We start from the most distant (max_bin_diff) and we arrive to 1.
-    max_bin_diff = np.max(ev_bin - lts_bin)
-
-    for bin_diff in range(max_bin_diff, 0, -1):
-        idxs = ev_bin == lts_bin + bin_diff
-        # Filter only events relevant to this case
-        ev_bin_good = ev_bin[idxs]
-        lts_bin_good = lts_bin[idxs]
-        ev_good = ev_fl[idxs]
-        lt_good = livetime_starts[idxs]
-
-        # find corresponding time bins
-        e_idx = np.searchsorted(tbin_starts, ev_good, 'right') - 1
-        _tbins = tbin_starts[e_idx]
-        livetime_array[ev_bin_good] += ev_good - _tbins
-        assert np.all(ev_good - _tbins >= 0), \
-            "Invalid boundaries. Contact the developer: {}".format(
-                ev_good - _tbins)
-
-        l_idx = np.searchsorted(tbin_starts, lt_good, 'right')
-        _tbins = tbin_starts[l_idx]
-        livetime_array[lts_bin_good] += _tbins - lt_good
-        assert np.all(_tbins - lt_good >= 0), \
-            "Invalid boundaries. Contact the developer: {}".format(
-                _tbins - lt_good)
-
-        # Complete bins
-        if bin_diff > 1:
-            for i in range(1, bin_diff):
-                livetime_array[lts_bin_good + i] += \
-                    dt[lts_bin_good + i]
+    # Process events in chunks, so that the temporary arrays stay in cache.
+    # The livetime array is the only state shared between chunks
+    for start in range(0, len(ev_fl), _CHUNK_SIZE):
+        chunk = slice(start, start + _CHUNK_SIZE)
+        _livetime_chunk(ev_fl[chunk], pr_fl[chunk], livetime_starts[chunk],
+                        tbins, dt, uniform, livetime_array)
 
     return livetime_array
 
@@ -159,7 +347,15 @@ def _plot_dead_time_from_uf(uf_file, outroot="expo"):
     shld_t = additional["SHLD_T"][1:]
     shld_hi = additional["SHLD_HI"][1:]
 
-    bins = np.percentile(dead_times, np.linspace(0, 100, 1000))
+    # Bin edges at 1000 evenly spaced percentiles of the dead times. Sorting
+    # once and interpolating linearly gives the same result as np.percentile,
+    # and one full sort is cheaper than its introselect partition with the
+    # ~2000 kth indices needed for 1000 interpolated quantiles.
+    sorted_dt = np.sort(dead_times)
+    pos = np.linspace(0, len(sorted_dt) - 1, 1000)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, len(sorted_dt) - 1)
+    bins = sorted_dt[lo] + (sorted_dt[hi] - sorted_dt[lo]) * (pos - lo)
     hist_all, bins_all = histogram(dead_times, bins=bins, density=True)
     hist_shield, bins_shield = histogram(dead_times[shields > 0], bins=bins,
                                          density=True)
@@ -182,8 +378,24 @@ def _plot_dead_time_from_uf(uf_file, outroot="expo"):
     ax1.legend()
     ax2 = plt.subplot(gs[1], sharex=ax1)
 
-    for sht in set(shld_t[shld_t > 0]):
-        hs, bs = histogram(dead_times[shld_t == sht], bins=bins, density=True)
+    # Histogram the dead times for all shield times at once, binning on
+    # (shield time, dead time) pairs
+    has_shld_t = shld_t > 0
+    dt_shld = dead_times[has_shld_t]
+    shld_t_values, shld_t_idx = np.unique(shld_t[has_shld_t],
+                                          return_inverse=True)
+    nbins = len(bins) - 1
+    bin_idx = np.searchsorted(bins, dt_shld, side='right') - 1
+    # The last bin is closed on the right, as in np.histogram
+    bin_idx[dt_shld == bins[-1]] = nbins - 1
+    valid = (bin_idx >= 0) & (bin_idx < nbins)
+    counts = np.bincount(shld_t_idx[valid] * nbins + bin_idx[valid],
+                         minlength=len(shld_t_values) * nbins)
+    counts = counts.reshape(len(shld_t_values), nbins)
+    hist_shld_t = \
+        counts / counts.sum(axis=1)[:, np.newaxis] / np.diff(bins)
+
+    for sht, hs in zip(shld_t_values, hist_shld_t):
         ax2.loglog(bin_centers, hs, drawstyle="steps-mid",
                    label="shield time {}".format(sht))
     ax2.set_xlabel("Dead time (s)")
@@ -215,8 +427,6 @@ def get_exposure_from_uf(time, uf_file, dt=None, gti=None):
         If time array is not sampled uniformly, dt can be specified here.
 
     """
-    dt = _assign_value_if_none(dt, np.median(np.diff(time)))
-
     additional_columns = ["PRIOR", "PI"]
 
     data = load_events_and_gtis(uf_file,
@@ -285,8 +495,10 @@ def correct_lightcurve(lc_file, uf_file, outname=None, expo_limit=1e-7):
 
     outdata = contents.copy()
 
-    newlc = np.array(lc / expo * dt, dtype=np.float64)
-    newlc[expo < expo_limit] = 0
+    # Divide only where the exposure is significant, leaving zeros elsewhere
+    newlc = np.zeros(len(lc), dtype=np.float64)
+    np.divide(lc, expo, out=newlc, where=expo >= expo_limit)
+    newlc *= dt
     outdata["lc"] = newlc
     outdata["expo"] = expo
 
@@ -316,6 +528,8 @@ def main(args=None):
                         default=False, action='store_true')
     parser.add_argument("--plot", help="Plot on window",
                         default=False, action='store_true')
+    parser.add_argument("--save-plots", help="Save diagnostic plots to file",
+                        default=False, action='store_true')
 
     args = parser.parse_args(args)
 
@@ -335,6 +549,11 @@ def main(args=None):
 
     outdata = correct_lightcurve(lc_file, uf_file, outname)
 
+    # Plots are expensive (the dead time distribution reloads the whole
+    # unfiltered event file), so only produce them when requested
+    if not (args.plot or args.save_plots):
+        return
+
     time = outdata["time"]
     lc = outdata["lc"]
     expo = outdata["expo"]
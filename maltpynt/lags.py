@@ -37,38 +37,36 @@ def calc_lags(freqs, cpds, pds1, pds2, n_chunks, rebin):
     lagse : array-like
         The errors on `lags`
     """
-    lags = np.angle(cpds) / (2 * np.pi * freqs)
-    sigcpd = np.absolute(cpds)
-
-    rawcof = (sigcpd) ** 2 / ((pds1) * (pds2))
-
-    dum = (1. - rawcof) / (2. * rawcof)
-
-    lagse = np.sqrt(dum / n_chunks / rebin) / (2 * np.pi * freqs)
-
-    bad = np.logical_or(lagse != lagse, lags != lags)
-
-    if np.any(bad):
-        logging.error('Bad element(s) in lag or lag error array:')
-        fbad = freqs[bad]
-        lbad = lags[bad]
-        lebad = lagse[bad]
-        cbad = cpds[bad]
-        p1bad = pds1[bad]
-        p2bad = pds2[bad]
-
-        for i, f in enumerate(fbad):
-            logging.error('--------------------------------------------------')
-            logging.error('Freq (Hz), Lag, Lag_err, CPDS (x + jy), PDS1, PDS2')
-            logging.error('--------------------------------------------------')
-            logging.error(" ".join([repr(fbad[i]),
-                                    repr(lbad[i]),
-                                    repr(lebad[i]),
-                                    repr(cbad[i]),
-                                    repr(p1bad[i]),
-                                    repr(p2bad[i])]
-                                   )
-                          )
+    twopif = np.multiply(freqs, 2 * np.pi)
+
+    lags = np.angle(cpds)
+    lags /= twopif
+
+    # Raw coherence. The squared modulus of the CPDS is calculated directly,
+    # and all subsequent operations are done in place to avoid temporaries
+    rawcof = cpds.real * cpds.real
+    rawcof += cpds.imag * cpds.imag
+    rawcof /= pds1
+    rawcof /= pds2
+
+    # (1 - rawcof) / (2 * rawcof) / n_chunks / rebin, reusing the buffer
+    lagse = np.reciprocal(rawcof, out=rawcof)
+    lagse -= 1.
+    lagse /= 2. * n_chunks * rebin
+    np.sqrt(lagse, out=lagse)
+    lagse /= twopif
+
+    bad = np.isnan(lagse)
+    bad |= np.isnan(lags)
+
+    if bad.any():
+        logging.error('{} bad element(s) in lag or lag error array'.format(
+            np.count_nonzero(bad)))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Freq (Hz), Lag, Lag_err, CPDS (x + jy), PDS1, PDS2')
+            for line in zip(freqs[bad], lags[bad], lagse[bad], cpds[bad],
+                            pds1[bad], pds2[bad]):
+                logging.debug(" ".join([repr(x) for x in line]))
         lags[bad] = 0
         lagse[bad] = 0
 
@@ -496,7 +496,7 @@ class TestFullRun(unittest.TestCase):
         lcname = os.path.join(datadir,
                               'monol_testA_E3-50_lc' + MP_FILE_EXTENSION)
         ufname = os.path.join(datadir, 'monol_testA_uf.evt')
-        command = "{0} {1}".format(lcname, ufname)
+        command = "{0} {1} --save-plots".format(lcname, ufname)
 
         mp.exposure.main(command.split())
 
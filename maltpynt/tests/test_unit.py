@@ -217,6 +217,124 @@ class TestAll(unittest.TestCase):
                                                 gti=None)
         np.testing.assert_almost_equal(expo, expected_expo)
 
+    def test_exposure_calculation_scalar_dt(self):
+        """Test the exposure calculator with a single bin width."""
+        times = np.array([1., 1.5, 2., 2.5, 3.])
+        events = np.array([2.6])
+        priors = np.array([1.5])
+        expected_expo = np.array([0.15, 0.5, 0.5, 0.35, 0])
+        expo = mp.exposure.get_livetime_per_bin(times, events, priors, dt=0.5,
+                                                gti=None)
+        np.testing.assert_almost_equal(expo, expected_expo)
+
+    def test_exposure_calculation_longdouble(self):
+        """Test the exposure calculator with long double times."""
+        times = np.array([1., 1.5, 2., 2.5, 3.], dtype=np.longdouble)
+        events = np.array([1.3, 2.6], dtype=np.longdouble)
+        priors = np.array([0.6, 1.])
+        expected_expo = np.array([0.5, 0.2, 0.5, 0.35, 0])
+        expo = mp.exposure.get_livetime_per_bin(times, events, priors,
+                                                dt=np.longdouble(0.5),
+                                                gti=None)
+        assert expo.dtype == np.float64
+        np.testing.assert_almost_equal(expo, expected_expo)
+
+    def test_exposure_calculation_numpy_fallback(self):
+        """Test the exposure calculator when Numba is not used."""
+        times = np.array([1., 1.5, 2., 2.5, 3.])
+        events = np.array([1.3, 2.6])
+        priors = np.array([0.6, 1.])
+        dt = np.array([0.5, 0.5, 0.5, 0.5, 0.5])
+        expected_expo = np.array([0.5, 0.2, 0.5, 0.35, 0])
+        has_numba = mp.exposure.HAS_NUMBA
+        try:
+            mp.exposure.HAS_NUMBA = False
+            expo = mp.exposure.get_livetime_per_bin(times, events, priors,
+                                                    dt=dt, gti=None)
+        finally:
+            mp.exposure.HAS_NUMBA = has_numba
+        np.testing.assert_almost_equal(expo, expected_expo)
+
+    def test_exposure_calculation_blocks(self):
+        """Test that splitting events in blocks does not change the result."""
+        tbins = np.arange(0, 10.5, 0.5)
+        dt = np.zeros(20) + 0.5
+        events = np.sort(np.random.uniform(0.1, 9.9, 100))
+        livetime_starts = np.append(0.05, events[:-1] + 0.001)
+        priors = events - livetime_starts
+        expo1 = mp.exposure._livetime_core(events, priors, livetime_starts,
+                                           tbins, dt, True, np.zeros(20))
+        expo2 = mp.exposure._livetime_core_parallel(
+            events, priors, livetime_starts, tbins, dt, True, np.zeros(20), 3)
+        np.testing.assert_almost_equal(expo1, expo2)
+
+    def test_exposure_calculation_blocks_many_bins(self):
+        """Test blocks covering different ranges of a long light curve."""
+        nbins = 20000
+        tbins = np.arange(nbins + 1) * 0.01
+        dt = np.zeros(nbins) + 0.01
+        events = np.sort(np.random.uniform(0.05, tbins[-1] - 0.05, 500))
+        livetime_starts = np.append(0.02, events[:-1] + 0.001)
+        priors = events - livetime_starts
+        expo1 = mp.exposure._livetime_core(events, priors, livetime_starts,
+                                           tbins, dt, True, np.zeros(nbins))
+        for n_blocks in [2, 7, 64]:
+            expo2 = mp.exposure._livetime_core_parallel(
+                events, priors, livetime_starts, tbins, dt, True,
+                np.zeros(nbins), n_blocks)
+            np.testing.assert_almost_equal(expo1, expo2)
+
+    @pytest.mark.skipif('not mp.exposure.HAS_NUMBA')
+    def test_exposure_calculation_parallel_longdouble(self):
+        """Test the parallel Numba kernel through get_livetime_per_bin."""
+        times = np.arange(np.longdouble(0), np.longdouble(10), 0.5) + 0.25
+        events = np.sort(np.random.uniform(0.1, 9.9, 100))
+        priors = np.append(0.05, np.diff(events) - 0.001)
+        expected = mp.exposure.get_livetime_per_bin(
+            times.astype(np.float64), events, priors, dt=0.5)
+        chunk_size = mp.exposure._CHUNK_SIZE
+        try:
+            mp.exposure._CHUNK_SIZE = 10
+            expo = mp.exposure.get_livetime_per_bin(
+                times, events.astype(np.longdouble), priors,
+                dt=np.longdouble(0.5))
+        finally:
+            mp.exposure._CHUNK_SIZE = chunk_size
+        assert expo.dtype == np.float64
+        np.testing.assert_almost_equal(expo, expected)
+
+    def test_exposure_find_bins_uniform(self):
+        """Test that uniform binning gives the same bins as searchsorted."""
+        tbins = np.arange(0, 10.01, 0.1)
+        values = np.concatenate([np.random.uniform(0, 10, 1000),
+                                 tbins[:-1]])
+        assert mp.exposure._is_uniform(tbins)
+        uniform = mp.exposure._find_bins(tbins, values, uniform=True)
+        ssorted = mp.exposure._find_bins(tbins, values, uniform=False)
+        assert np.all(uniform == ssorted)
+
+    def test_calc_lags(self):
+        """Test the lag calculation on a constant phase shift."""
+        freqs = np.array([0.5, 1., 2.])
+        cpds = 0.5 * np.exp(1j * np.array([0.1, 0.2, 0.3]))
+        pds1 = np.ones(3)
+        pds2 = np.ones(3)
+        lags, lagse = mp.lags.calc_lags(freqs, cpds, pds1, pds2, 10, 2)
+        twopif = 2 * np.pi * freqs
+        np.testing.assert_almost_equal(lags, np.array([0.1, 0.2, 0.3]) /
+                                       twopif)
+        np.testing.assert_almost_equal(lagse, np.sqrt(1.5 / 20) / twopif)
+
+    def test_calc_lags_bad_elements(self):
+        """Test that invalid lags and lag errors are set to zero."""
+        freqs = np.array([0.5, 1., 2.])
+        cpds = np.array([0.5, 0.5 + 0.5j, 0.3j])
+        pds1 = np.array([1., 0., 1.])
+        pds2 = np.ones(3)
+        lags, lagse = mp.lags.calc_lags(freqs, cpds, pds1, pds2, 10, 2)
+        assert lags[1] == 0 and lagse[1] == 0
+        assert np.all(np.isfinite(lags)) and np.all(np.isfinite(lagse))
+
     def test_high_precision_keyword(self):
         """Test high precision FITS keyword read."""
         from maltpynt.io import high_precision_keyword_read